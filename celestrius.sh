@@ -169,8 +169,6 @@ configure() {
 
 enable() {
   PYTHONPATH="${CEL_DIR}:${PYTHONPATH}" ${CEL_ENV}/bin/python3 -m moonraker_celestrius.config -c "${CEL_CFG_FILE}" -e
-  report_status "Restarting moonraker-celestrius systemctl service... You may need to enter password to run sudo."
-  sudo systemctl restart "${CEL_SERVICE_NAME}"
   cat <<EOF
 ${cyan}
 Celestrius data collection enabled!
@@ -189,8 +187,6 @@ EOF
 
 
 disable() {
-  report_status "Restarting moonraker-celestrius systemctl service... You may need to enter password to run sudo."
-  sudo systemctl restart "${CEL_SERVICE_NAME}"
   PYTHONPATH="${CEL_DIR}:${PYTHONPATH}" ${CEL_ENV}/bin/python3 -m moonraker_celestrius.config -c "${CEL_CFG_FILE}" -d
      cat <<EOF
 ${cyan}
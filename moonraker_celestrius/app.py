@@ -8,6 +8,8 @@ import logging
 import threading
 import collections
 import queue
+import concurrent.futures
+import io
 import json
 import re
 import signal
@@ -25,7 +27,10 @@ from google.cloud import storage
 from shapely import geometry
 
 from .logger import setup_logging
-from .moonraker_conn import MoonrakerConn, Event
+from .config import CelestriusSettings, ConfigWatcher, NOZZLE_CAMERA
+from .buffer_pool import BufferPool
+from .gcode_objects import ObjectPolygonCache
+from .moonraker_conn import MoonrakerConn, GcodeOffsetDispatcher, Event
 
 _logger = logging.getLogger('celestrius')
 
@@ -36,9 +41,15 @@ class App(object):
         self.config = ConfigParser()
         self.config.read(cmd_args.config)
         setup_logging(dict(self.config['logging']))
+        self.config_path = cmd_args.config
+        self.settings = CelestriusSettings.from_config(self.config)
 
         self._mutex = threading.RLock()
         self.moonrakerconn = None
+        self.gcode_dispatcher = None
+        self.polygon_cache = None
+        self.frame_pool = BufferPool(max_free=8)
+        self.camera_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix='camera')
         self.current_flow_rate = 1.0
         self.current_z_offset = None
         self.printer_stats = None
@@ -53,15 +64,26 @@ class App(object):
 
     def start(self):
         self.moonrakerconn = MoonrakerConn(dict(self.config['moonraker']), self.on_moonraker_ws_msg, self.on_moonraker_ws_closed)
+        self.gcode_dispatcher = GcodeOffsetDispatcher(self.moonrakerconn)
+        self.polygon_cache = ObjectPolygonCache(self.moonrakerconn)
 
         thread = threading.Thread(target=self.moonrakerconn.start)
         thread.daemon = True
         thread.start()
 
+        thread = threading.Thread(target=self.gcode_dispatcher.start)
+        thread.daemon = True
+        thread.start()
+
+        thread = threading.Thread(target=ConfigWatcher(self.config_path, self.on_config_changed).start)
+        thread.daemon = True
+        thread.start()
+
         SNAPSHOTS_INTERVAL_SECS = 0.4
         MAX_SNAPSHOT_NUM_IN_PRINT = int(60.0 / SNAPSHOTS_INTERVAL_SECS * 30)  # limit sampling to 30 minutes
         last_collect = 0.0
         data_dirname = None
+        polygons_filename = None
         snapshot_num_in_current_print = 0
 
         while True:
@@ -83,18 +105,25 @@ class App(object):
                             data_dirname = os.path.join(os.path.expanduser('~'), 'celestrius-data',f'{filename}.{print_id}')
                             os.makedirs(data_dirname, exist_ok=True)
 
-                            filename_lower = filename.lower()
-                            if "celestrius" in filename_lower and "offset" in filename_lower:
-                                objs = self.moonrakerconn.find_all_gcode_objects()
+                            if is_z_offset_calibration_file(filename):
                                 with self._mutex:
                                     self.num_polygon_seen = 0
                                     self.z_offset_stepping_activated = False
                                     self.init_z_offset = None
-                                    all_objects = objs.get('status', {}).get('exclude_object', {}).get('objects', [])
-                                    _logger.debug(f'Found objects: {all_objects}')
-                                    for obj in all_objects:
-                                        self.object_polygons.append(geometry.Polygon(obj.get('polygon')))
 
+                                # Normally already fetched (or being fetched) since the job was queued or started.
+                                # Capture goes on while it's not ready yet; z-offset testing is activated once it is.
+                                polygons_filename = printer_stats.get('filename')
+                                self.polygon_cache.prefetch(polygons_filename, printing=True)
+
+                        if polygons_filename is not None:
+                            object_polygons = self.polygon_cache.get(polygons_filename)
+                            if object_polygons is None:
+                                self.polygon_cache.prefetch(polygons_filename, printing=True)  # No-op while a fetch is in flight; retries after a failed one
+                            else:
+                                polygons_filename = None
+                                with self._mutex:
+                                    self.object_polygons = list(object_polygons)
                                     if len(self.object_polygons) > 1:
                                         _logger.warning(f'Found {len(self.object_polygons)} objects. Activating z-offset testing')
                                         self.z_offset_stepping_activated = True
@@ -105,18 +134,28 @@ class App(object):
                             last_collect = ts
                             snapshot_num_in_current_print += 1
 
-                            jpg = self.capture_jpeg()
-                            with open(f'{data_dirname}/{ts}.jpg', 'wb') as f:
-                                f.write(jpg)
+                            frames = self.capture_jpegs(ts)
+                            try:
+                                for name, (frame, skew) in frames.items():
+                                    jpg_filename = f'{ts}.jpg' if name == NOZZLE_CAMERA else f'{ts}.{name}.jpg'
+                                    with open(f'{data_dirname}/{jpg_filename}', 'wb') as f, frame.view() as jpg:
+                                        f.write(jpg)
+                            finally:
+                                for frame, _ in frames.values():
+                                    frame.release()
                             with open(f'{data_dirname}/{ts}.labels', 'w') as f:
                                 with self._mutex:
                                     f.write(f'flow_rate:{self.current_flow_rate}\n')
                                     f.write(f'z_offset:{self.current_z_offset}\n')
+                                    f.write(f'z_offset_applied_at:{self.gcode_dispatcher.applied_at}\n')
+                                for name, (_, skew) in frames.items():
+                                    f.write(f'{name}_camera_skew:{skew:.3f}\n')
 
                     elif printer_stats.get('state') in ['paused',]:
                         pass
                     else:
                         if data_dirname is not None:
+                            _logger.debug('Frame buffer pool stats: %s', self.frame_pool.stats())
                             data_dirname_to_compress = data_dirname
                             compress_thread = threading.Thread(target=self.compress_and_upload, args=(data_dirname_to_compress,))
                             compress_thread.daemon = True
@@ -125,9 +164,7 @@ class App(object):
                         if self.init_z_offset is not None:
                             init_z_offset = self.init_z_offset
                             _logger.warning(f'Resetting Z-offset to {init_z_offset}...')
-                            z_offset_thread = threading.Thread(target=self.moonrakerconn.api_post, args=('printer/gcode/script',), kwargs=dict(script=f'SET_GCODE_OFFSET Z={init_z_offset} MOVE=1'))
-                            z_offset_thread.daemon = True
-                            z_offset_thread.start()
+                            self.gcode_dispatcher.set_z_offset(init_z_offset)
 
                         self.temperature_reached = False
                         self.object_polygons = []
@@ -138,6 +175,7 @@ class App(object):
                         self.num_polygon_seen = 0
                         snapshot_num_in_current_print = 0
                         data_dirname = None
+                        polygons_filename = None
 
             except Exception as e:
                 _logger.exception('Exception occurred: %s', e)
@@ -178,29 +216,53 @@ class App(object):
         bucket = client.bucket('celestrius-data-collection')
         basename = os.path.basename((filename))
         with open(filename, 'rb') as f:
-            blob = bucket.blob(f"{self.config.get('celestrius', 'pilot_email')}/{basename}")
+            blob = bucket.blob(f"{self.settings.pilot_email}/{basename}")
             blob.upload_from_file(f, timeout=None)
 
     def should_collect(self):
+        settings = self.settings
         with self._mutex:
-            return self.config.get('celestrius', 'pilot_email') is not None and \
-                self.config.get('celestrius', 'enabled', fallback="False").lower() == "true" and self.current_z < 0.5 and \
+            return settings.pilot_email is not None and settings.enabled and self.current_z < 0.5 and \
                     self.temperature_reached
 
+    def on_config_changed(self, config):
+        settings = CelestriusSettings.from_config(config)
+        if settings.enabled != self.settings.enabled:
+            _logger.warning('Data collection %s', 'enabled' if settings.enabled else 'disabled')
+        self.settings = settings
+
     def on_moonraker_ws_msg(self, msg):
         try:
-            print_stats = msg.get('result', {}).get('status', {}).get('print_stats')
+            if 'id' in msg:
+                self.gcode_dispatcher.on_jsonrpc_reply(msg)
+
+            result = msg.get('result')
+            status = result.get('status', {}) if isinstance(result, dict) else {}  # e.g. "ok" in reply to printer.gcode.script
+
+            print_stats = status.get('print_stats')
             if print_stats:
                 with self._mutex:
+                    prev_state = (self.printer_stats or {}).get('state')
                     self.printer_stats = print_stats
 
-            gcode_move = msg.get('result', {}).get('status', {}).get('gcode_move')
+                filename = print_stats.get('filename')
+                if print_stats.get('state') == 'printing' and prev_state != 'printing' and filename and is_z_offset_calibration_file(filename):
+                    self.polygon_cache.prefetch(filename)
+
+            if msg.get('method') == 'notify_job_queue_changed':
+                for job in (msg.get('params') or [{}])[0].get('updated_queue') or []:
+                    if is_z_offset_calibration_file(job.get('filename', '')):
+                        self.polygon_cache.prefetch(job.get('filename'))
+
+            gcode_move = status.get('gcode_move')
             if gcode_move:
                 with self._mutex:
                     self.current_flow_rate = gcode_move.get('extrude_factor')
                     self.current_z_offset = gcode_move.get('homing_origin', [None, None, None, None])[2]
                     current_position = gcode_move.get('gcode_position', [-1, -1, 100, -1])
                     self.current_z = current_position[2]
+                    if self.current_z_offset is not None:
+                        self.gcode_dispatcher.on_homing_origin(self.current_z_offset)
 
                     if self.z_offset_stepping_activated and self.should_collect():
                         point = geometry.Point(current_position[0], current_position[1])
@@ -209,22 +271,20 @@ class App(object):
                             if poly.covers(point):
                                 cur_polygon_idx = idx
 
-                        _logger.debug(f'Current polygon {cur_polygon_idx}')
+                        _logger.debug('Current polygon %s', cur_polygon_idx)
                         if cur_polygon_idx is not None:
                             if self.cur_polygon_idx != cur_polygon_idx:
                                 self.cur_polygon_linger_start = datetime.now().timestamp()
                             elif self.cur_polygon_linger_start and (datetime.now().timestamp() - self.cur_polygon_linger_start) > 5:
                                 self.cur_polygon_linger_start = None
                                 self.num_polygon_seen += 1
-                                new_z_offset = round(self.init_z_offset + self.config.getfloat('celestrius', 'z_offset_increment', fallback=0.1) * (self.num_polygon_seen-1), 3)
+                                new_z_offset = round(self.init_z_offset + self.settings.z_offset_increment * (self.num_polygon_seen-1), 3)
                                 _logger.warning(f'Lingered in {cur_polygon_idx} for longer than 5s. Increasing Z-offset to {new_z_offset}...')
-                                z_offset_thread = threading.Thread(target=self.moonrakerconn.api_post, args=('printer/gcode/script',), kwargs=dict(script=f'SET_GCODE_OFFSET Z={new_z_offset} MOVE=1'))
-                                z_offset_thread.daemon = True
-                                z_offset_thread.start()
+                                self.gcode_dispatcher.set_z_offset(new_z_offset)
 
                         self.cur_polygon_idx = cur_polygon_idx
 
-            extruder = msg.get('result', {}).get('status', {}).get('extruder')
+            extruder = status.get('extruder')
             if extruder and extruder.get('target', 0) > 150 and extruder.get('temperature', 0) > extruder.get('target') - 2:
                 with self._mutex:
                     self.temperature_reached = True
@@ -236,13 +296,52 @@ class App(object):
         with self._mutex:
             self.printer_stats = None
 
-    def capture_jpeg(self):
-        snapshot_url = self.config.get('nozzle_camera', 'snapshot_url')
-        if snapshot_url:
-            r = requests.get(snapshot_url, stream=True, timeout=5, verify=False )
+    def capture_jpegs(self, capture_ts):
+        # Fetch all cameras in parallel. Returns {name: (frame, skew)}, where skew is how long after capture_ts
+        # the camera responded. A failed nozzle camera fails the whole tick; other cameras are just left out.
+        cameras = self.settings.cameras
+        if NOZZLE_CAMERA not in dict(cameras):
+            raise Exception('No snapshot_url configured for the nozzle camera')
+
+        futures = {name: self.camera_executor.submit(self.capture_jpeg, snapshot_url) for name, snapshot_url in cameras}
+        frames = {}
+        error = None
+        for name, future in futures.items():
+            try:
+                frame, responded_at = future.result()
+                frames[name] = (frame, responded_at - capture_ts)
+            except Exception as e:
+                if name == NOZZLE_CAMERA:
+                    error = e
+                else:
+                    _logger.warning('Failed to capture from %s camera: %s', name, e)
+
+        if error is not None:
+            for frame, _ in frames.values():
+                frame.release()
+            raise error
+
+        return frames
+
+    def capture_jpeg(self, snapshot_url):
+        with requests.get(snapshot_url, stream=True, timeout=5, verify=False ) as r:
+            responded_at = datetime.now().timestamp()
             r.raise_for_status()
-            jpg = r.content
-            return jpg
+            frame = self.frame_pool.acquire()
+            try:
+                if r.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+                    # r.raw bypasses content decoding. Let requests decode it, at the cost of the extra copy.
+                    content = r.content
+                    return frame.read_from(io.BytesIO(content), size_hint=len(content)), responded_at
+                return frame.read_from(r.raw, size_hint=int(r.headers.get('Content-Length', 0))), responded_at
+            except Exception:
+                frame.release()
+                raise
+
+
+def is_z_offset_calibration_file(filename):
+    filename_lower = os.path.basename(filename).lower()
+    return "celestrius" in filename_lower and "offset" in filename_lower
 
 
 if __name__ == '__main__':
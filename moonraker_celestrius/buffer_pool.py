@@ -0,0 +1,85 @@
+import threading
+import collections
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class Frame:
+
+    def __init__(self, pool, buf):
+        self.pool = pool
+        self.buf = buf
+        self.length = 0
+
+    def view(self):
+        # Callers must release the view (use it as a context manager) before the frame is released
+        return memoryview(self.buf)[:self.length]
+
+    def ensure_capacity(self, size):
+        if size > len(self.buf):
+            self.buf.extend(bytes(size - len(self.buf)))
+            self.pool.count('grown')
+
+    def read_from(self, stream, size_hint=0):
+        # size_hint is the exact body size when known (Content-Length); reading stops there without probing for EOF
+        self.length = 0
+        self.ensure_capacity(size_hint)
+        while not size_hint or self.length < size_hint:
+            if self.length == len(self.buf):
+                # Only grow if there's actually more data, not just to read EOF
+                probe = bytearray(1)
+                if not stream.readinto(probe):
+                    break
+                self.ensure_capacity(len(self.buf) * 2)
+                self.buf[self.length] = probe[0]
+                self.length += 1
+                continue
+
+            with memoryview(self.buf)[self.length:self.length + READ_CHUNK_SIZE] as chunk:
+                n = stream.readinto(chunk)
+            if not n:
+                break
+            self.length += n
+
+        return self
+
+    def release(self):
+        self.pool.release(self.buf)
+        self.buf = None
+
+
+class BufferPool:
+    """
+    A small pool of bytearrays that snapshots are streamed into, so that capturing a frame doesn't allocate a
+    fresh bytes object for every response body.
+    """
+
+    def __init__(self, buffer_size=1024 * 1024, max_free=4):
+        self.buffer_size = buffer_size
+        self.max_free = max_free
+        self._mutex = threading.Lock()
+        self._free = collections.deque()
+        self._counters = collections.Counter()
+
+    def acquire(self):
+        with self._mutex:
+            if self._free:
+                self._counters['reused'] += 1
+                return Frame(self, self._free.pop())
+            self._counters['allocated'] += 1
+        return Frame(self, bytearray(self.buffer_size))
+
+    def release(self, buf):
+        with self._mutex:
+            if len(self._free) < self.max_free:
+                self._free.append(buf)
+            else:
+                self._counters['discarded'] += 1
+
+    def count(self, name):
+        with self._mutex:
+            self._counters[name] += 1
+
+    def stats(self):
+        with self._mutex:
+            return dict(self._counters, free=len(self._free))
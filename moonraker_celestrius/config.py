@@ -1,18 +1,89 @@
+from typing import Tuple
 import configparser
+import dataclasses
+import logging
 import os
 import argparse
 import signal
 import sys
+import time
 import requests
 
+_logger = logging.getLogger('celestrius.config')
+
 CYAN='\033[0;96m'
 RED='\033[0;31m'
 NC='\033[0m' # No Color
 
+NOZZLE_CAMERA = 'nozzle'
+
 def config_interrupted(signum, frame):
     print('')
     sys.exit(1)
 
+
+@dataclasses.dataclass(frozen=True)
+class CelestriusSettings:
+    """
+    Immutable, already-parsed view of the cfg values read on the hot paths.
+    Replaced as a whole (never mutated) when the cfg file changes.
+    """
+    pilot_email: str = None
+    enabled: bool = False
+    z_offset_increment: float = 0.1
+    cameras: Tuple[Tuple[str, str], ...] = ()  # (name, snapshot_url) pairs from the [<name>_camera] sections, nozzle first
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            pilot_email=config.get('celestrius', 'pilot_email', fallback=None),
+            enabled=config.get('celestrius', 'enabled', fallback='False').strip().lower() == 'true',
+            z_offset_increment=config.getfloat('celestrius', 'z_offset_increment', fallback=0.1),
+            cameras=tuple(sorted(
+                ((section[:-len('_camera')], config.get(section, 'snapshot_url'))
+                    for section in config.sections() if section.endswith('_camera') and config.get(section, 'snapshot_url', fallback='')),
+                key=lambda camera: camera[0] != NOZZLE_CAMERA)),
+        )
+
+
+class ConfigWatcher:
+    poll_interval_secs = 0.25
+
+    def __init__(self, config_path, on_change):
+        self.config_path = config_path
+        self.on_change = on_change
+
+    def stat(self):
+        try:
+            st = os.stat(self.config_path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def start(self) -> None:
+        last_stat = self.stat()
+        while True:
+            time.sleep(self.poll_interval_secs)
+            try:
+                cur_stat = self.stat()
+                if cur_stat is None or cur_stat == last_stat:
+                    continue
+
+                last_stat = cur_stat
+                config = configparser.ConfigParser()
+                config.read(self.config_path)
+                self.on_change(config)
+            except Exception as e:
+                _logger.exception(e)
+
+
+def write_config(config, config_path):
+    # Write to a temp file and rename so that a running service never reads a half-written cfg
+    tmp_path = config_path + '.tmp'
+    with open(tmp_path, "w") as f:
+        config.write(f)
+    os.replace(tmp_path, config_path)
+
 def configure(config_path):
 
     # Create a ConfigParser object and read the config file
@@ -100,10 +171,10 @@ uploaded to the server.
     log_path = os.path.join(os.path.dirname(config_path), 'logs', 'moonraker-celestrius.log')
     config.set("logging", "path", log_path)
     config.set("logging", "level", config.get("logging", "level", fallback="INFO"))
+    config.set("logging", "debug_max_per_sec", config.get("logging", "debug_max_per_sec", fallback="0"))
 
     # Save the updated configuration to the config file
-    with open(config_path, "w") as f:
-        config.write(f)
+    write_config(config, config_path)
 
 
 def enable(config_path, enabled):
@@ -118,8 +189,7 @@ def enable(config_path, enabled):
 
         config.set("celestrius", "enabled", str(enabled))
         # Save the updated configuration to the config file
-        with open(config_path, "w") as f:
-            config.write(f)
+        write_config(config, config_path)
 
     else:
         config_interrupted(None, None)
@@ -0,0 +1,130 @@
+import re
+import json
+import logging
+import threading
+import backoff
+from collections import OrderedDict
+import shapely.errors
+from shapely import geometry
+
+_logger = logging.getLogger('celestrius.gcode_objects')
+_polygon_pattern = re.compile(r'POLYGON=(\[\[.*?\]\])')
+
+
+def parse_object_polygons(lines):
+    # Returns None if the file doesn't define every object with a polygon. Objects may then be defined by a
+    # macro, or without polygons, and only Klipper knows the complete list.
+    polygons = []
+    for line in lines:
+        line = line.lstrip()
+        if line.startswith(b'EXCLUDE_OBJECT_START'):  # All objects must have been defined by the time the first one is started
+            break
+        if not line.startswith(b'EXCLUDE_OBJECT_DEFINE'):
+            continue
+
+        m = _polygon_pattern.search(line.decode(errors='replace'))
+        if not m:
+            return None
+        try:
+            polygons.append(geometry.Polygon(json.loads(m.group(1))))
+        except (ValueError, TypeError, shapely.errors.ShapelyError) as e:  # json.JSONDecodeError is a ValueError
+            _logger.warning('Invalid object polygon in %s: %s', line, e)
+            return None
+
+    return polygons or None
+
+
+def to_polygon(coords):
+    # An empty polygon keeps the object's index without ever covering a point
+    try:
+        return geometry.Polygon(coords)
+    except (ValueError, TypeError, shapely.errors.ShapelyError) as e:
+        _logger.warning('Invalid object polygon %s: %s', coords, e)
+        return geometry.Polygon()
+
+
+class ObjectPolygonCache:
+    """
+    Object polygons of G-code files, keyed by (filename, modified time) so that reprints of an unchanged file
+    don't fetch or parse it again. Files are fetched and parsed on a background thread.
+
+    When the file alone can't tell the objects, the polygons of the file that is currently printing are taken
+    from Klipper's exclude_object status instead. Those aren't cached across prints.
+    """
+
+    def __init__(self, moonrakerconn, max_entries=8):
+        self.moonrakerconn = moonrakerconn
+        self.max_entries = max_entries
+        self._mutex = threading.RLock()
+        self._cache = OrderedDict()
+        self._latest_modified = {}
+        self._inflight = set()
+        self._klipper_polygons = {}
+
+    def prefetch(self, filename, printing=False):
+        # printing=True means `filename` is the file currently being printed (so Klipper's status can be used)
+        with self._mutex:
+            if printing:
+                self._klipper_polygons.pop(filename, None)
+            if filename in self._inflight:
+                return
+            self._inflight.add(filename)
+
+        thread = threading.Thread(target=self.fetch, args=(filename, printing))
+        thread.daemon = True
+        thread.start()
+
+    def fetch(self, filename, printing=False):
+        try:
+            modified = self.moonrakerconn.get_file_metadata(filename).get('modified')
+            key = (filename, modified)
+            with self._mutex:
+                cached = key in self._cache
+                polygons = self._cache.get(key)
+
+            if not cached:
+                polygons = self.scan_file(filename)
+                _logger.info('Found %s objects in %s', len(polygons) if polygons is not None else 'no complete', filename)
+
+                with self._mutex:
+                    self._cache[key] = polygons
+                    while len(self._cache) > self.max_entries:
+                        self._cache.popitem(last=False)
+
+            if polygons is None and printing:
+                objs = self.moonrakerconn.find_all_gcode_objects()
+                all_objects = objs.get('status', {}).get('exclude_object', {}).get('objects', [])
+                _logger.debug('Found objects: %s', all_objects)
+                with self._mutex:
+                    self._klipper_polygons[filename] = [to_polygon(obj.get('polygon')) for obj in all_objects]
+
+            with self._mutex:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                self._latest_modified[filename] = modified
+
+        except Exception as e:
+            _logger.exception('Failed to fetch objects in %s: %s', filename, e)
+
+        finally:
+            with self._mutex:
+                self._inflight.discard(filename)
+
+    def scan_file(self, filename):
+        with self.open_gcode_file(filename) as resp:
+            return parse_object_polygons(resp.iter_lines())
+
+    @backoff.on_exception(backoff.expo, Exception, max_value=60, max_time=300)
+    def open_gcode_file(self, filename):
+        return self.moonrakerconn.stream_gcode_file(filename)
+
+    def get(self, filename):
+        # Returns None while the file is still being fetched, or if its objects aren't known (yet). In the latter
+        # case, prefetch again (with printing=True for the current print) to retry.
+        with self._mutex:
+            if filename in self._inflight or filename not in self._latest_modified:
+                return None
+            polygons = self._cache.get((filename, self._latest_modified[filename]))
+            if polygons is None:
+                return self._klipper_polygons.get(filename)
+            return polygons
@@ -1,8 +1,54 @@
+import atexit
 import logging
 import logging.handlers
+import queue
 import sys
+import threading
+import time
+
+_listener = None
+
+
+class DeferredFormatQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats the message on the calling thread. Keep msg/args as they are so that
+    # formatting (e.g. str() of a whole Moonraker payload) happens on the listener's thread instead.
+    # Only safe as long as the args aren't mutated after being logged.
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class DebugRateLimitFilter(logging.Filter):
+    # Lets at most `max_per_sec` DEBUG records through per call site (source file + line number),
+    # so full-traffic debugging can stay on without flooding the log or stalling the hot paths.
+
+    def __init__(self, max_per_sec):
+        super().__init__()
+        self.max_per_sec = max_per_sec
+        self._mutex = threading.Lock()
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno != logging.DEBUG:
+            return True
+
+        key = (record.pathname, record.lineno)  # Bounded by the number of logging calls in the code
+        now = time.monotonic()
+        with self._mutex:
+            window_start, count = self._windows.get(key, (0.0, 0))
+            if now - window_start >= 1.0:
+                window_start, count = now, 0
+            count += 1
+            self._windows[key] = (window_start, count)
+            return count <= self.max_per_sec
+
 
 def setup_logging(logging_config):
+    global _listener
+
     handlers = []
     log_level_info = {'DEBUG': logging.DEBUG,
                       'INFO': logging.INFO,
@@ -28,8 +74,30 @@ def setup_logging(logging_config):
         fh.setFormatter(formatter)
         handlers.append(fh)
 
+    stop_logging()
+
+    # The actual (blocking) handlers run on the listener's background thread. Callers only pay for a queue put.
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredFormatQueueHandler(log_queue)
+
+    debug_max_per_sec = int(logging_config.get('debug_max_per_sec', 0) or 0)
+    if debug_max_per_sec > 0:
+        queue_handler.addFilter(DebugRateLimitFilter(debug_max_per_sec))
+
     for hdlr in logger.handlers[:]:
         logger.removeHandler(hdlr)
 
-    for hdlr in handlers:
-        logger.addHandler(hdlr)
+    logger.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+@atexit.register
+def stop_logging():
+    # Flushes whatever is still queued before the process exits
+    global _listener
+
+    if _listener:
+        _listener.stop()
+        _listener = None
@@ -7,10 +7,12 @@ import threading
 import requests  # type: ignore
 import logging
 import time
+import urllib.parse
 import backoff
 import json
 import bson
 import websocket
+from datetime import datetime
 from random import randrange
 from collections import deque, OrderedDict
 
@@ -46,7 +48,7 @@ class MoonrakerConn:
 
     def api_get(self, mr_method, timeout=5, raise_for_status=True, **params):
         url = f'{self.http_address()}/{mr_method.replace(".", "/")}'
-        _logger.debug(f'GET {url}')
+        _logger.debug('GET %s', url)
 
         headers = {'X-Api-Key': self.api_key} if self.api_key else {}
         resp = requests.get(
@@ -63,7 +65,7 @@ class MoonrakerConn:
 
     def api_post(self, mr_method, multipart_filename=None, multipart_fileobj=None, **post_params):
         url = f'{self.http_address()}/{mr_method.replace(".", "/")}'
-        _logger.debug(f'POST {url}')
+        _logger.debug('POST %s', url)
 
         headers = {'X-Api-Key': self.api_key} if self.api_key else {}
         files={'file': (multipart_filename, multipart_fileobj, 'application/octet-stream')} if multipart_filename and multipart_fileobj else None
@@ -107,6 +109,19 @@ class MoonrakerConn:
     def find_all_gcode_objects(self):
         return self.api_get('printer/objects/query?exclude_object=')
 
+    @backoff.on_exception(backoff.expo, Exception, max_value=60, max_time=300)
+    def get_file_metadata(self, filename):
+        return self.api_get('server/files/metadata', raise_for_status=True, filename=filename)
+
+    def stream_gcode_file(self, filename):
+        url = f'{self.http_address()}/server/files/gcodes/{urllib.parse.quote(filename)}'
+        _logger.debug('GET %s', url)
+
+        headers = {'X-Api-Key': self.api_key} if self.api_key else {}
+        resp = requests.get(url, headers=headers, stream=True, timeout=5)
+        resp.raise_for_status()
+        return resp
+
     ## WebSocket part
 
     def start(self) -> None:
@@ -146,7 +161,7 @@ class MoonrakerConn:
                 return
 
             data = json.loads(raw)
-            _logger.debug(f'Received from Moonraker: {data}')
+            _logger.debug('Received from Moonraker: %s', data)
 
             'notify_status_update',
             if data.get('method') == 'notify_status_update':
@@ -176,7 +191,7 @@ class MoonrakerConn:
                         self.klippy_ready.wait()
                         _logger.info('Klippy ready')
 
-                _logger.debug("Sending to Moonraker: \n{}".format(data))
+                _logger.debug('Sending to Moonraker: \n%s', data)
                 self.conn.send(json.dumps(data, default=str))
             except Exception as e:
                 _logger.exception(e)
@@ -200,8 +215,10 @@ class MoonrakerConn:
 
         try:
             self.ws_message_queue_to_moonraker.put_nowait(payload)
+            return next_id
         except queue.Full:
             _logger.warning("Moonraker message queue is full, msg dropped")
+            return None
 
 
     def request_subscribe(self, objects=None):
@@ -223,6 +240,95 @@ class MoonrakerConn:
 
         self.jsonrpc_request('printer.objects.query', params=dict(objects=objects))
 
+class GcodeOffsetDispatcher:
+    """
+    Sends SET_GCODE_OFFSET commands to Moonraker one at a time, in order, over the websocket connection.
+    A newer offset supersedes one that hasn't been confirmed yet (latest wins). A command is confirmed by Moonraker's
+    reply to it or when `gcode_move.homing_origin` reports the requested value, whichever comes first. An error
+    reply (e.g. axes not homed) ends it; commands that get neither are retried.
+    """
+    confirm_timeout_secs = 10
+    max_attempts = 3
+
+    def __init__(self, moonrakerconn):
+        self.moonrakerconn = moonrakerconn
+        self._cond = threading.Condition()
+        self._requested = None
+        self._inflight = None
+        self._sent_at = None
+        self._request_id = None
+        self.applied_z_offset = None
+        self.applied_at = None
+
+    def start(self) -> None:
+        while True:
+            try:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._requested is not None)
+                    z_offset = self._inflight = self._requested
+                    self._requested = None
+
+                self.dispatch(z_offset)
+
+            except Exception as e:
+                _logger.exception(e)
+
+    def dispatch(self, z_offset):
+        for attempt in range(1, self.max_attempts + 1):
+            with self._cond:  # Held while sending so that the reply can't be processed before the request id is known
+                self._sent_at = time.monotonic()
+                self._request_id = self.moonrakerconn.jsonrpc_request('printer.gcode.script', params=dict(script=f'SET_GCODE_OFFSET Z={z_offset} MOVE=1'))
+
+            with self._cond:
+                self._cond.wait_for(lambda: self._inflight is None or self._requested is not None, timeout=self.confirm_timeout_secs)
+                if self._inflight is None:
+                    return
+                if self._requested is not None:
+                    _logger.info('Z-offset %s superseded by %s before being confirmed', z_offset, self._requested)
+                    self._inflight = None
+                    return
+
+            _logger.warning('Z-offset %s not confirmed after %ss (attempt %d/%d)', z_offset, self.confirm_timeout_secs, attempt, self.max_attempts)
+
+        with self._cond:
+            self._inflight = None
+        _logger.error('Giving up on setting Z-offset to %s', z_offset)
+
+    def set_z_offset(self, z_offset):
+        with self._cond:
+            # Nothing will change (and hence nothing will confirm it) if the offset is already in effect
+            if self._inflight is None and self.applied_z_offset is not None and abs(z_offset - self.applied_z_offset) < 1e-6:
+                _logger.debug('Z-offset %s already in effect', z_offset)
+                self._requested = None
+                return
+
+            self._requested = z_offset
+            self._cond.notify_all()
+
+    def on_jsonrpc_reply(self, msg):
+        with self._cond:
+            if self._inflight is None or self._request_id is None or msg.get('id') != self._request_id:
+                return
+
+            if 'error' in msg:
+                _logger.error('Setting Z-offset to %s failed: %s', self._inflight, (msg.get('error') or {}).get('message'))
+            else:
+                _logger.info('Z-offset %s acknowledged in %.3fs', self._inflight, time.monotonic() - self._sent_at)
+            self._inflight = None
+            self._cond.notify_all()
+
+    def on_homing_origin(self, z_offset):
+        with self._cond:
+            if z_offset != self.applied_z_offset:
+                self.applied_z_offset = z_offset
+                self.applied_at = datetime.now().timestamp()
+
+            if self._inflight is not None and abs(z_offset - self._inflight) < 1e-6:
+                _logger.info('Z-offset %s confirmed in %.3fs', z_offset, time.monotonic() - self._sent_at)
+                self._inflight = None
+                self._cond.notify_all()
+
+
 @dataclasses.dataclass
 class Event:
     name: str